@@ -12,6 +12,7 @@ class AHT21:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.name = config.get_name().split()[-1]
+        self._log_prefix = "aht21 {}:".format(self.name)
         self.reactor = self.printer.get_reactor()
         self.i2c = bus.MCU_I2C_from_config(
             config, default_addr=AHTX0_I2CADDR_DEFAULT, default_speed=400000)
@@ -19,6 +20,9 @@ class AHT21:
             "report_time", default=2.0, minval=2.0)
         self.sample_timer = self.reactor.register_timer(self._sample_aht21)
         self.aht21 = None
+        self._status_callbacks = []
+        self._monotonic = self.reactor.monotonic
+        self._estimated_print_time = None
 
         self.temp = self.min_temp = self.max_temp = self.humidity = 0.
         self.printer.add_object("aht21 " + self.name, self)
@@ -27,6 +31,7 @@ class AHT21:
 
     def handle_connect(self):
         self.aht21 = AHTx0(self.i2c, self.reactor)
+        self._estimated_print_time = self.i2c.get_mcu().estimated_print_time
         self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
 
     def setup_minmax(self, min_temp, max_temp):
@@ -36,26 +41,39 @@ class AHT21:
     def setup_callback(self, cb):
         self._callback = cb
 
+    def add_status_callback(self, cb):
+        # cb(status) is invoked with get_status() after every sample so
+        # consumers can cache it instead of polling
+        self._status_callbacks.append(cb)
+
+    def _notify_status(self, eventtime):
+        if self._status_callbacks:
+            status = self.get_status(eventtime)
+            for cb in self._status_callbacks:
+                cb(status)
+
     def get_report_time_delta(self):
         return self.report_time
 
     def _sample_aht21(self, eventtime):
-        measured_time = self.reactor.monotonic()
+        measured_time = self._monotonic()
 
         try:
             self.temp, self.humidity = self.aht21.read_data()
         except Exception as err:
-            logging.exception("aht21 {}: Error reading data - {}"
-                              .format(self.name, err))
+            logging.exception("%s Error reading data - %s",
+                              self._log_prefix, err)
             self.temp = self.humidity = .0
+            self._notify_status(measured_time)
             return self.reactor.NEVER
 
         if self.temp < self.min_temp or self.temp > self.max_temp:
             self.printer.invoke_shutdown(
-                "aht21 %s: temperature %0.1f outside range of %0.1f:%.01f"
-                % (self.name, self.temp, self.min_temp, self.max_temp))
+                "%s temperature %0.1f outside range of %0.1f:%.01f"
+                % (self._log_prefix, self.temp, self.min_temp, self.max_temp))
 
-        print_time = self.i2c.get_mcu().estimated_print_time(measured_time)
+        self._notify_status(measured_time)
+        print_time = self._estimated_print_time(measured_time)
         self._callback(print_time, self.temp)
         return measured_time + self.report_time
 
@@ -75,6 +93,12 @@ AHTX0_CMD_TRIGGER = 0xAC  # Trigger reading command
 AHTX0_CMD_SOFTRESET = 0xBA  # Soft reset command
 AHTX0_STATUS_BUSY = 0x80  # Status bit for busy
 AHTX0_STATUS_CALIBRATED = 0x08  # Status bit for calibrated
+AHTX0_CALIBRATE_DELAY = 0.01  # Calibration time in seconds
+AHTX0_MEASUREMENT_DELAY = 0.08  # Measurement time in seconds (datasheet)
+AHTX0_BUSY_DELAY = 0.01  # Wait between status reads while busy
+AHTX0_BUSY_RETRIES = 2  # Extra status reads if the sensor is still busy
+AHTX0_HUMIDITY_SCALE = 100.0 / 0x100000  # 20 bit raw value to %RH
+AHTX0_TEMP_SCALE = 200.0 / 0x100000  # 20 bit raw value to deg C (+ -50)
 
 
 class AHTx0:
@@ -98,9 +122,15 @@ class AHTx0:
         """Ask the sensor to self-calibrate.
            Returns True on success, False otherwise"""
         self._i2c.i2c_write([AHTX0_CMD_CALIBRATE, 0x08, 0x00])
-        while self.status & AHTX0_STATUS_BUSY:
-            self._reactor.pause(self._reactor.monotonic() + 0.01)
-        if not self.status & AHTX0_STATUS_CALIBRATED:
+        self._reactor.pause(self._reactor.monotonic() + AHTX0_CALIBRATE_DELAY)
+        status = self.status
+        for _ in range(AHTX0_BUSY_RETRIES):
+            if not status & AHTX0_STATUS_BUSY:
+                break
+            self._reactor.pause(self._reactor.monotonic() + AHTX0_BUSY_DELAY)
+            status = self.status
+        if status & AHTX0_STATUS_BUSY or \
+                not status & AHTX0_STATUS_CALIBRATED:
             return False
         return True
 
@@ -109,23 +139,31 @@ class AHTx0:
         """The status byte initially returned from the sensor,
            see datasheet for details"""
         params = self._i2c.i2c_read([], 1)
-        buf = bytearray(params['response'])
-        return buf[0]
+        return params['response'][0]
 
     def read_data(self):
         """Internal function for triggering the AHT to read temp/humidity"""
+        # i2c_write is queued to the mcu without waiting for a response,
+        # so the data read below is the only host<->mcu round trip
         self._i2c.i2c_write([AHTX0_CMD_TRIGGER, 0x33, 0x00])
 
-        while self.status & AHTX0_STATUS_BUSY:
-            self._reactor.pause(self._reactor.monotonic() + 0.08)
-
-        params = self._i2c.i2c_read([], 6)
-        buf = bytearray(params['response'])
-
-        humidity = ((buf[1] << 12) | (buf[2] << 4) | (buf[3] >> 4))
-        humidity = (humidity * 100) / 0x100000
-        temp = ((buf[3] & 0xF) << 16) | (buf[4] << 8) | buf[5]
-        temp = ((temp * 200.0) / 0x100000) - 50
+        # the measurement takes a fixed amount of time - wait it out once
+        # and use the status byte leading the data instead of polling
+        self._reactor.pause(
+            self._reactor.monotonic() + AHTX0_MEASUREMENT_DELAY)
+        r = self._i2c.i2c_read([], 6)['response']
+        for _ in range(AHTX0_BUSY_RETRIES):
+            if not r[0] & AHTX0_STATUS_BUSY:
+                break
+            self._reactor.pause(self._reactor.monotonic() + AHTX0_BUSY_DELAY)
+            r = self._i2c.i2c_read([], 6)['response']
+        if r[0] & AHTX0_STATUS_BUSY:
+            raise RuntimeError("Sensor busy")
+
+        # 20 bits of humidity followed by 20 bits of temperature
+        raw = int.from_bytes(r[1:6], 'big')
+        humidity = (raw >> 20) * AHTX0_HUMIDITY_SCALE
+        temp = (raw & 0xFFFFF) * AHTX0_TEMP_SCALE - 50
 
         return temp, humidity
 
@@ -5,12 +5,12 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
 import logging
-import csv
 import time
 import struct
 import threading
-import queue
 import datetime
+import collections
+import array
 
 from . import bus
 
@@ -19,6 +19,7 @@ class ENS160:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.name = config.get_name().split()[1]
+        self._log_prefix = "ens160 {}:".format(self.name)
         self.reactor = self.printer.get_reactor()
         self.i2c = bus.MCU_I2C_from_config(
             config, default_addr=ENS160_I2CADDR_DEFAULT, default_speed=400000)
@@ -27,10 +28,12 @@ class ENS160:
         self.sample_timer = self.reactor.register_timer(self.sample_ens160)
         self.syslog_time = config.getfloat(
             "syslog_time", default=self.reactor.NEVER)
-        self.syslog_last_updated = self.reactor.NOW
+        self.syslog_timer = self.reactor.register_timer(self.syslog_ens160)
         self.csv_basename = config.get("csv_basename", default=None)
-        self.csv_log_queue = queue.Queue()
-        self.eCO2 = self.TVOC = None
+        self.csv_log_queue = collections.deque()
+        self.csv_log_event = threading.Event()
+        self.csv_dropped = 0
+        self.AQI = self.eCO2 = self.TVOC = None
         self.ens160 = None
         self.temperature_sensor = None
         self.temperature_sensor_name = config.get(
@@ -40,6 +43,8 @@ class ENS160:
         self.temperature_initial = config.getfloat(
             "temperature_initial", default=None)  # units deg C
         self.temperature_last = None
+        self.temperature_status = {
+            self.temperature_key: self.temperature_initial}
         self.humidity_sensor = None
         self.humidity_sensor_name = config.get(
             "humidity_sensor", default=self.temperature_sensor_name)
@@ -47,19 +52,21 @@ class ENS160:
         self.humidity_initial = config.getfloat(
             "humidity_initial", default=None)  # units RH %
         self.humidity_last = None
+        self.humidity_status = {self.humidity_key: self.humidity_initial}
+        self._shared_th_sensor = False
         self.printer.add_object("ens160 " + self.name, self)
         self.printer.register_event_handler(
             "klippy:connect", self.handle_connect)
 
         if not self.temperature_sensor_name and not self.temperature_initial:
             raise config.error(
-                "ens160 {}: must specify either 'temperature_sensor'"
-                " or 'temperature_initial'".format(self.name))
+                "{} must specify either 'temperature_sensor'"
+                " or 'temperature_initial'".format(self._log_prefix))
 
         if not self.humidity_sensor_name and not self.humidity_initial:
             raise config.error(
-                "ens160 {}: must specify either 'humidity_sensor'"
-                " or 'humidity_initial'".format(self.name))
+                "{} must specify either 'humidity_sensor'"
+                " or 'humidity_initial'".format(self._log_prefix))
 
         gcode = self.printer.lookup_object('gcode')
         gcode.register_mux_command("AIR_QUALITY_CSV_LOGGING_START",
@@ -75,53 +82,94 @@ class ENS160:
 
     def cmd_CSV_LOGGING_START(self, gcmd):
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
+            self.queue_csv_item({
                 "type": "start",
                 "gcmd": gcmd
             })
         else:
-            gcmd.respond_info("ens160 {}: csv_basename not specified"
-                              .format(self.name))
+            gcmd.respond_info("{} csv_basename not specified"
+                              .format(self._log_prefix))
 
     def cmd_CSV_LOGGING_STOP(self, gcmd):
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
+            self.queue_csv_item({
                 "type": "stop",
                 "gcmd": gcmd
             })
         else:
-            gcmd.respond_info("ens160 {}: csv_basename not specified"
-                              .format(self.name))
+            gcmd.respond_info("{} csv_basename not specified"
+                              .format(self._log_prefix))
+
+    def queue_csv_item(self, item):
+        # the reactor is the only producer and csv_logger the only consumer,
+        # deque append is atomic so only take the event lock to wake it up.
+        # samples are dropped rather than growing without bound, start/stop
+        # are always queued so their gcode gets a reply
+        if len(self.csv_log_queue) >= CSV_QUEUE_SIZE \
+                and isinstance(item, ENS160Sample):
+            self.csv_dropped += 1
+            if self.csv_dropped % CSV_DROP_WARN == 1:
+                logging.warning("%s csv logger is behind, dropped %d rows",
+                                self._log_prefix, self.csv_dropped)
+            return
+        self.csv_log_queue.append(item)
+        if not self.csv_log_event.is_set():
+            self.csv_log_event.set()
 
     def handle_connect(self):
         self.ens160 = DFRobot_ENS160(self.i2c, self.reactor)
 
         if self.temperature_sensor_name:
-            self.temperature_sensor = self.printer.lookup_object(
-                self.temperature_sensor_name)
+            self.temperature_sensor = self._lookup_status_sensor(
+                self.temperature_sensor_name, self._handle_temperature_status)
 
         if self.humidity_sensor_name:
-            self.humidity_sensor = self.printer.lookup_object(
-                self.humidity_sensor_name)
+            self.humidity_sensor = self._lookup_status_sensor(
+                self.humidity_sensor_name, self._handle_humidity_status)
+
+        # a single polled sensor commonly provides both values
+        self._shared_th_sensor = self.temperature_sensor is not None \
+            and self.humidity_sensor is self.temperature_sensor
 
         if self.csv_basename:
             threading.Thread(target=csv_logger, args=(
-                self.name, self.csv_basename,
-                self.reactor, self.csv_log_queue)).start()
+                self._log_prefix, self.csv_basename,
+                self.reactor, self.csv_log_queue,
+                self.csv_log_event)).start()
 
         self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
+        if self.syslog_time > 0:
+            self.reactor.update_timer(
+                self.syslog_timer, self.reactor.monotonic() + self.syslog_time)
+
+    def _lookup_status_sensor(self, name, status_cb):
+        # subscribe to sensors that push their status after each sample,
+        # any other sensor is returned so it is polled every sample
+        sensor = self.printer.lookup_object(name)
+        if not hasattr(sensor, "add_status_callback"):
+            return sensor
+        status_cb(sensor.get_status(self.reactor.monotonic()))
+        sensor.add_status_callback(status_cb)
+        return None
+
+    def _handle_temperature_status(self, status):
+        self.temperature_status = status
+
+    def _handle_humidity_status(self, status):
+        self.humidity_status = status
 
     def sample_ens160(self, eventtime):
         measured_time = self.reactor.monotonic()
 
         # update ens160 temp/humidity to aid with measurement compensation
         temperature_status = self.temperature_sensor.get_status(eventtime) \
-            if self.temperature_sensor \
-            else {self.temperature_key: self.temperature_initial}
+            if self.temperature_sensor else self.temperature_status
         tempC = temperature_status[self.temperature_key]
-        humidity_status = self.humidity_sensor.get_status(eventtime) \
-            if self.humidity_sensor \
-            else {self.humidity_key: self.humidity_initial}
+        if self._shared_th_sensor:
+            humidity_status = temperature_status
+        else:
+            humidity_status = self.humidity_sensor.get_status(eventtime) \
+                if self.humidity_sensor else self.humidity_status
         humidity = humidity_status[self.humidity_key]
 
         try:
@@ -130,42 +178,35 @@ class ENS160:
                 self.ens160.set_temp_and_hum(tempC, humidity)
 
             # perform measurement
-            status, aqi, self.TVOC, self.eCO2 = self.ens160.air_quality()
-            hydrogen, acetone, carbon_monoxide, toluene = self.ens160.raw()
+            status, self.AQI, self.TVOC, self.eCO2, \
+                hydrogen, acetone, carbon_monoxide, toluene = \
+                self.ens160.read_all()
         except Exception as err:
             logging.exception(
-                "ens160 {}: Error reading data - {}".format(self.name, err))
-            self.eCO2 = self.TVOC = .0
+                "%s Error reading data - %s", self._log_prefix, err)
+            self.AQI = self.eCO2 = self.TVOC = .0
+            # sampling has stopped, so has the measurement to log
+            self.reactor.update_timer(self.syslog_timer, self.reactor.NEVER)
             return self.reactor.NEVER
 
-        # log measurement to syslog
-        now = self.reactor.monotonic()
-        if self.syslog_time > 0:
-            if now - self.syslog_last_updated > self.syslog_time:
-                logging.info("ens160 {}: measured - AQI: {}, eCO2: {}, TVOC: {}"
-                             .format(self.name, aqi, self.eCO2, self.TVOC))
-                self.syslog_last_updated = now
-
         # log measurement to csv
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
-                "type": "update",
-                "monotonic": now,
-                "status": status,
-                "aqi": aqi,
-                "eco2": self.eCO2,
-                "tvoc": self.TVOC,
-                "hydrogenRaw": hydrogen,
-                "acetoneRaw": acetone,
-                "carbonMonoxideRaw": carbon_monoxide,
-                "tolueneRaw": toluene,
-                "temperature": temperature_status,
-                "humidity": humidity_status
-            })
+            self.queue_csv_item(ENS160Sample(
+                time.time(), measured_time, self.AQI, self.eCO2, self.TVOC,
+                hydrogen, acetone, carbon_monoxide, toluene, status,
+                temperature_status, humidity_status))
 
         # schedule next loop
         return measured_time + self.report_time
 
+    def syslog_ens160(self, eventtime):
+        # log the latest measurement to syslog, once there is one
+        if self.AQI is None:
+            return eventtime + self.syslog_time
+        logging.info("%s measured - AQI: %s, eCO2: %s, TVOC: %s",
+                     self._log_prefix, self.AQI, self.eCO2, self.TVOC)
+        return eventtime + self.syslog_time
+
     def get_status(self, eventtime):
         return {
             'eco2': self.eCO2,
@@ -173,64 +214,122 @@ class ENS160:
         }
 
 
-def csv_logger(name, basename, reactor, data_queue):
+# csv "update" record, the leading CSV_SAMPLE_FIELDS fields are written as is
+ENS160Sample = collections.namedtuple('ENS160Sample', [
+    'unix', 'monotonic', 'aqi', 'eco2', 'tvoc', 'hydrogen_raw', 'acetone_raw',
+    'carbon_monoxide_raw', 'toluene_raw', 'status',
+    'temperature', 'humidity'])
+CSV_SAMPLE_FIELDS = 9
+CSV_HEADER = ['unix_time', 'monotonic_time', 'AQI', 'ECO2', 'TVOC',
+              'hydrogen_raw', 'acetone_raw', 'carbon_monoxide_raw',
+              'toluene_raw']
+
+CSV_QUEUE_SIZE = 4096  # new samples are dropped once this many are queued
+CSV_DROP_WARN = 100  # warn on the first and every this many dropped rows
+CSV_BUFFER_SIZE = 1 << 16
+CSV_FLUSH_TIME = 5.0  # seconds between flushes of buffered csv rows
+
+
+def csv_value(value):
+    # a status value as csv.writer would write it: numbers at full
+    # precision, None as an empty cell and anything else quoted if needed
+    if value.__class__ is float or value.__class__ is int:
+        return repr(value).encode()
+    if value is None:
+        return b""
+    value = str(value)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        value = '"' + value.replace('"', '""') + '"'
+    return value.encode()
+
+
+def csv_logger(log_prefix, basename, reactor, data_queue, data_event):
+    csvfile = None
     try:
         def gcmd_result(gcmd, val):
             reactor.register_async_callback((lambda e: gcmd.respond_info(val)))
 
-        csvfile = None
-        csvwriter = None
+        row_format = None
+        pending = False
+        last_flush = time.monotonic()
         while True:
-            item = data_queue.get()
-            item_type = item['type']
-            if item_type == "start":
-                if not csvfile:
-                    filename = basename + datetime.datetime.now().strftime(
-                        "_%Y-%m-%d_%H-%M-%S.csv")
-                    csvfile = open(filename, 'w')
-                    gcmd_result(item['gcmd'],
-                                "ens160 {}: csv logging started '{}'"
-                                .format(name, filename))
-                else:
-                    gcmd_result(item['gcmd'],
-                                "ens160 {}: csv logging already started"
-                                .format(name))
-            elif item_type == "stop":
-                if csvfile:
-                    csvfile.close()
-                    csvfile = None
-                    csvwriter = None
-                    gcmd_result(item['gcmd'],
-                                "ens160 {}: csv logging stopped".format(name))
-                else:
-                    gcmd_result(item['gcmd'],
-                                "ens160 {}: csv logging already stopped"
-                                .format(name))
-            elif item_type == "update" and csvfile:
-                t = item['temperature']
-                h = item['humidity']
-
-                if not csvwriter:
-                    csvwriter = csv.writer(csvfile)
-                    row = ['unix_time', 'monotonic_time', 'AQI', 'ECO2', 'TVOC',
-                           'hydrogen_raw', 'acetone_raw', 'carbon_monoxide_raw',
-                           'toluene_raw']
-                    row.extend("temperature_{}".format(x) for x in sorted(t))
-                    row.extend("humidity_{}".format(x) for x in sorted(h))
-                    csvwriter.writerow(row)
-
-                row = [time.time(), item['monotonic'], item['aqi'],
-                       item['eco2'], item['tvoc'], item['hydrogenRaw'],
-                       item['acetoneRaw'], item['carbonMonoxideRaw'],
-                       item['tolueneRaw']]
-                row.extend(t[k] for k in sorted(t))
-                row.extend(h[k] for k in sorted(h))
-                csvwriter.writerow(row)
+            # wake up once the reactor queues something, then drain. with
+            # rows buffered give up waiting after CSV_FLUSH_TIME and write
+            # them out, sampling may have stopped
+            if not data_event.wait(CSV_FLUSH_TIME if pending else None):
                 csvfile.flush()
-
-            data_queue.task_done()
+                pending = False
+                last_flush = time.monotonic()
+                continue
+            data_event.clear()
+            while data_queue:
+                item = data_queue.popleft()
+                item_type = "update" if isinstance(item, ENS160Sample) \
+                    else item['type']
+                if item_type == "start":
+                    if not csvfile:
+                        filename = basename + \
+                            datetime.datetime.now().strftime(
+                                "_%Y-%m-%d_%H-%M-%S.csv")
+                        csvfile = open(filename, 'wb',
+                                       buffering=CSV_BUFFER_SIZE)
+                        last_flush = time.monotonic()
+                        gcmd_result(item['gcmd'],
+                                    "{} csv logging started '{}'"
+                                    .format(log_prefix, filename))
+                    else:
+                        gcmd_result(item['gcmd'],
+                                    "{} csv logging already started"
+                                    .format(log_prefix))
+                elif item_type == "stop":
+                    if csvfile:
+                        csvfile.close()
+                        csvfile = None
+                        row_format = None
+                        pending = False
+                        gcmd_result(item['gcmd'],
+                                    "{} csv logging stopped"
+                                    .format(log_prefix))
+                    else:
+                        gcmd_result(item['gcmd'],
+                                    "{} csv logging already stopped"
+                                    .format(log_prefix))
+                elif item_type == "update" and csvfile:
+                    t = item.temperature
+                    h = item.humidity
+
+                    if not row_format:
+                        # the columns are all numeric, write rows straight
+                        # from a fixed format instead of going through csv
+                        t_keys = tuple(sorted(t))
+                        h_keys = tuple(sorted(h))
+                        row = list(CSV_HEADER)
+                        row.extend("temperature_{}".format(x) for x in t_keys)
+                        row.extend("humidity_{}".format(x) for x in h_keys)
+                        csvfile.write((",".join(row) + "\n").encode())
+                        row_format = b"%.6f,%.6f" \
+                            + b",%d" * (CSV_SAMPLE_FIELDS - 2) \
+                            + b",%s" * (len(t_keys) + len(h_keys)) + b"\n"
+
+                    # a key missing from a later status is an empty cell
+                    csvfile.write(row_format % (
+                        item[:CSV_SAMPLE_FIELDS]
+                        + tuple([csv_value(t.get(k)) for k in t_keys])
+                        + tuple([csv_value(h.get(k)) for k in h_keys])))
+
+                    # let the file buffer coalesce rows, flush periodically
+                    now = time.monotonic()
+                    if now - last_flush > CSV_FLUSH_TIME:
+                        csvfile.flush()
+                        pending = False
+                        last_flush = now
+                    else:
+                        pending = True
     except Exception as err:
-        logging.exception("ens160 {}: csv error - {}".format(name, err))
+        logging.exception("%s csv error - %s", log_prefix, err)
+    finally:
+        if csvfile:
+            csvfile.close()
 
 
 # The DFRobot_ENS160 class is heavily inspired/taken from
@@ -294,6 +393,17 @@ ENS160_SLEEP_MODE = 0x00  # DEEP SLEEP mode (low power standby).
 ENS160_IDLE_MODE = 0x01  # IDLE mode (low-power).
 ENS160_STANDARD_MODE = 0x02  # STANDARD Gas Sensing Modes.
 
+# register layouts, compiled once rather than per sample
+_PART_ID_STRUCT = struct.Struct('<H')
+_DATA_STRUCT = struct.Struct('<BBHH')  # status, aqi, tvoc, eco2
+_GPR_READ_STRUCT = struct.Struct('<HHHH')
+_TEMP_HUM_STRUCT = struct.Struct('<BHH')  # register, temperature, humidity
+
+# GPR_READ raw resistance conversion 2^(x/2048) for every 16 bit value,
+# shared by all sensors (~256KB)
+_RAW_RESISTANCE = array.array(
+    'I', (int(2.0**(x/2048.0)) for x in range(0x10000)))
+
 
 class DFRobot_ENS160:
     def __init__(self, i2c, reactor):
@@ -309,36 +419,43 @@ class DFRobot_ENS160:
                 "Expected ENS160 part id: 0x{:04X}, got 0x{:04X}"
                 .format(ENS160_PART_ID, part_id))
 
+        # the sensor settles once after both config writes
         self.set_PWR_mode(ENS160_STANDARD_MODE)
         self.set_INT_mode(0x02)
+        self._reactor.pause(self._reactor.monotonic() + 0.025)
 
     def part_id(self):
         params = self._i2c.i2c_read([ENS160_PART_ID_REG], 2)
-        return struct.unpack('<H', params['response'])[0]
+        return _PART_ID_STRUCT.unpack(params['response'])[0]
 
     def air_quality(self):
         params = self._i2c.i2c_read([ENS160_DATA_STATUS_REG], 6)
         # status, aqi, tvoc, eco2
-        return struct.unpack('<BBHH', params['response'])
+        return _DATA_STRUCT.unpack(params['response'])
 
     def set_PWR_mode(self, mode):
         self._i2c.i2c_write([ENS160_OPMODE_REG, mode])
-        self._reactor.pause(self._reactor.monotonic() + 0.02)
 
     def set_INT_mode(self, mode):
         self._i2c.i2c_write([ENS160_CONFIG_REG, mode])
-        self._reactor.pause(self._reactor.monotonic() + 0.02)
 
     def set_temp_and_hum(self, temperature_C, humidity_rh):
         temp = int((temperature_C + 273.15) * 64)
         rh = int(humidity_rh * 512)
-        self._i2c.i2c_write(struct.pack("<BHH", ENS160_TEMP_IN_REG, temp, rh))
+        self._i2c.i2c_write(
+            _TEMP_HUM_STRUCT.pack(ENS160_TEMP_IN_REG, temp, rh))
 
     def raw(self):
         params = self._i2c.i2c_read([ENS160_GPR_READ_REG], 8)
         # hydrogen, acetone, carbon monoxide, toluene
-        vals = struct.unpack('<HHHH', params['response'])
-        return list(int(2.0**(x/2048.0)) for x in vals)
+        vals = _GPR_READ_STRUCT.unpack(params['response'])
+        return [_RAW_RESISTANCE[x] for x in vals]
+
+    def read_all(self):
+        """Read the air quality data and the raw gas resistances back to
+           back, returns status, aqi, tvoc, eco2 followed by hydrogen,
+           acetone, carbon monoxide and toluene"""
+        return self.air_quality() + tuple(self.raw())
 
 
 def load_config_prefix(config):
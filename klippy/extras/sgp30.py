@@ -6,13 +6,13 @@
 
 from math import exp
 import logging
-import configparser
-import csv
 import time
 import datetime
 import threading
 import queue
-import os.path
+import collections
+import struct
+import os
 
 from . import bus
 
@@ -31,15 +31,23 @@ class SGP30:
             "syslog_time", default=self.reactor.NEVER)
         self.syslog_last_updated = self.reactor.NOW
         self.csv_basename = config.get("csv_basename", default=None)
-        self.csv_log_queue = queue.Queue()
+        self.csv_log_queue = collections.deque()
+        self.csv_log_event = threading.Event()
+        self.csv_dropped = 0
+        self.csv_keys = None
         self.mcu = self.i2c.get_mcu()
         self.eCO2 = self.TVOC = self.H2Raw = self.EthanolRaw = None
         self.sgp30 = None
         cfgname = self.printer.get_start_args()['config_file']
         self.baseline_timer = None
         self.baseline_filename = os.path.join(
+            os.path.dirname(cfgname),
+            "sgp30_baseline_{}.cfg".format(self.name))
+        # older versions kept every sensor in one shared file
+        self.legacy_baseline_filename = os.path.join(
             os.path.dirname(cfgname), "sgp30_baseline.cfg")
         self.baseline_update_request = False
+        self.baseline_write_queue = queue.Queue()
         self.baseline_eco2 = None
         self.baseline_tvoc = None
         self.baseline_last_updated = None
@@ -64,6 +72,8 @@ class SGP30:
         self.humidity_initial = config.getfloat(
             "humidity_initial", default=None)  # units RH %
         self.humidity_last = None
+        # last (temperature, humidity) sent for compensation, 0.1 resolution
+        self._last_th = (None, None)
         self.printer.add_object("sgp30 " + self.name, self)
         self.printer.register_event_handler(
             "klippy:connect", self.handle_connect)
@@ -92,7 +102,7 @@ class SGP30:
 
     def cmd_CSV_LOGGING_START(self, gcmd):
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
+            self.queue_csv_item({
                 "type": "start",
                 "gcmd": gcmd
             })
@@ -102,7 +112,7 @@ class SGP30:
 
     def cmd_CSV_LOGGING_STOP(self, gcmd):
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
+            self.queue_csv_item({
                 "type": "stop",
                 "gcmd": gcmd
             })
@@ -110,10 +120,32 @@ class SGP30:
             gcmd.respond_info("sgp30 {}: csv_basename not specified"
                               .format(self.name))
 
+    def queue_csv_item(self, item):
+        # the reactor is the only producer and csv_logger the only consumer,
+        # deque append is atomic so only take the event lock to wake it up.
+        # rows are dropped rather than growing without bound, control items
+        # are always queued so gcode gets a reply and files their header
+        if len(self.csv_log_queue) >= CSV_QUEUE_SIZE \
+                and isinstance(item, bytes):
+            self.csv_dropped += 1
+            if self.csv_dropped % CSV_DROP_WARN == 1:
+                logging.warning("sgp30 {}: csv logger is behind, dropped {}"
+                                " rows".format(self.name, self.csv_dropped))
+            return
+        self.csv_log_queue.append(item)
+        if not self.csv_log_event.is_set():
+            self.csv_log_event.set()
+
     def handle_connect(self):
+        baseline_filename = self.baseline_filename
+        if not os.path.exists(baseline_filename) \
+                and os.path.exists(self.legacy_baseline_filename):
+            baseline_filename = self.legacy_baseline_filename
+            logging.info("sgp30 {}: reading baseline from {}".format(
+                self.name, baseline_filename))
         try:
             self.baseline_last_updated, self.baseline_eco2, self.baseline_tvoc \
-                = read_baseline(self.baseline_filename, self.name)
+                = read_baseline(baseline_filename, self.name)
         except Exception as err:
             logging.error(
                 "sgp30 {}: Failed to read baseline - {}".format(self.name, err))
@@ -132,16 +164,21 @@ class SGP30:
 
         # https://cdn-learn.adafruit.com/downloads/pdf/adafruit-sgp30-gas-tvoc-eco2-mox-sensor.pdf
         # See section: Baseline Set & Get
-        now = datetime.datetime.utcnow()
         if not self.baseline_last_updated or \
-                now - self.baseline_last_updated > datetime.timedelta(
-                    seconds=self.baseline_stale_time):
-
+                time.time() - self.baseline_last_updated > \
+                self.baseline_stale_time:
+            # a sensor that is still running may be part way through its
+            # initial learning, its baseline is not trusted any sooner
             baseline_initial_delay = self.baseline_initial_measurement_time
             logging.warning(
                 "sgp30 {}: no previous baseline, sampling for {:.2f} hours"
                 .format(self.name,
                         self.baseline_initial_measurement_time/3600.0))
+        elif self.sgp30.warm_start:
+            baseline_initial_delay = self.baseline_measurement_time
+            logging.info(
+                "sgp30 {}: sensor still running, keeping its baseline"
+                .format(self.name))
         else:
             baseline_initial_delay = self.baseline_measurement_time
             self.sgp30.set_iaq_baseline(self.baseline_eco2, self.baseline_tvoc)
@@ -150,6 +187,11 @@ class SGP30:
                 .format(self.name, self.baseline_eco2, self.baseline_tvoc))
 
         if baseline_initial_delay > 0.0:
+            # a single background writer, a slow disk must not cause
+            # print hiccups
+            threading.Thread(target=baseline_writer, args=(
+                self.baseline_filename, self.name,
+                self.baseline_write_queue), daemon=True).start()
             self.baseline_timer = self.reactor.register_timer(
                 self.update_baseline)
             self.reactor.update_timer(
@@ -162,7 +204,8 @@ class SGP30:
         if self.csv_basename:
             threading.Thread(target=csv_logger, args=(
                 self.name, self.csv_basename,
-                self.reactor, self.csv_log_queue)).start()
+                self.reactor, self.csv_log_queue,
+                self.csv_log_event)).start()
 
         self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
 
@@ -182,17 +225,15 @@ class SGP30:
             try:
                 self.baseline_eco2, self.baseline_tvoc = \
                     self.sgp30.get_iaq_baseline()
-                self.baseline_last_updated = datetime.datetime.utcnow()
+                self.baseline_last_updated = time.time()
                 self.baseline_update_request = False
 
                 # put disk io in background thread
                 # do not want a slow disk to cause print hiccups
-                threading.Thread(target=write_baseline,
-                                 args=(self.baseline_filename,
-                                       self.name,
-                                       self.baseline_last_updated,
-                                       self.baseline_eco2,
-                                       self.baseline_tvoc)).start()
+                self.baseline_write_queue.put_nowait((
+                    self.baseline_last_updated,
+                    self.baseline_eco2,
+                    self.baseline_tvoc))
                 logging.info(
                     "sgp30 {}: read baseline - eCO2: {}, TVOC: {}"
                     .format(self.name, self.baseline_eco2, self.baseline_tvoc))
@@ -212,8 +253,12 @@ class SGP30:
 
         try:
             # require both temperature/humidity to update sgp30 compensation
+            # the sensor keeps the last value, only resend it on a change
             if tempC and humidity:
-                self.sgp30.set_iaq_relative_humidity(tempC, humidity)
+                th = (round(tempC, 1), round(humidity, 1))
+                if th != self._last_th:
+                    self.sgp30.set_iaq_relative_humidity(tempC, humidity)
+                    self._last_th = th
 
             # perform measurement
             self.eCO2, self.TVOC = self.sgp30.iaq_measure()
@@ -225,29 +270,49 @@ class SGP30:
             return self.reactor.NEVER
 
         # log measurement to syslog
-        now = self.reactor.monotonic()
         if self.syslog_time > 0:
-            if now - self.syslog_last_updated > self.syslog_time:
+            if measured_time - self.syslog_last_updated > self.syslog_time:
                 logging.info("sgp30 {}: measured - eCO2: {}, TVOC: {}"
                              .format(self.name, self.eCO2, self.TVOC))
-                self.syslog_last_updated = now
+                self.syslog_last_updated = measured_time
 
-        # log measurement to csv
+        # log measurement to csv, the row is formatted here so the
+        # logger thread only has to write it
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
-                "type": "update",
-                "monotonic": now,
-                "eco2": self.eCO2,
-                "tvoc": self.TVOC,
-                "h2raw": self.H2Raw,
-                "ethanolraw": self.EthanolRaw,
-                "temperature": temperature_status,
-                "humidity": humidity_status
-            })
+            try:
+                self._queue_csv_row(
+                    measured_time, temperature_status, humidity_status)
+            except Exception as err:
+                logging.exception("sgp30 {}: Error formatting csv row - {}"
+                                  .format(self.name, err))
 
         # schedule next loop
         return measured_time + self.report_time
 
+    def _queue_csv_row(self, measured_time, temperature_status,
+                       humidity_status):
+        # status dicts keep the same keys from sample to sample, only sort
+        # them again if the key sets change
+        keys = self.csv_keys
+        if keys is None or temperature_status.keys() != keys[2] \
+                or humidity_status.keys() != keys[3]:
+            t_keys = tuple(sorted(temperature_status))
+            h_keys = tuple(sorted(humidity_status))
+            keys = self.csv_keys = (t_keys, h_keys,
+                                    frozenset(t_keys), frozenset(h_keys))
+            self.queue_csv_item({
+                "type": "header",
+                "header": csv_header(CSV_COLUMNS, t_keys, h_keys)
+            })
+        row = b"%.6f,%.6f,%d,%d,%d,%d" % (
+            time.time(), measured_time, self.eCO2, self.TVOC,
+            self.H2Raw, self.EthanolRaw)
+        row += b"".join([b"," + csv_value(temperature_status[k])
+                         for k in keys[0]])
+        row += b"".join([b"," + csv_value(humidity_status[k])
+                         for k in keys[1]])
+        self.queue_csv_item(row + b"\n")
+
     def get_status(self, eventtime):
         return {
             'eco2': self.eCO2,
@@ -258,90 +323,155 @@ class SGP30:
 
 
 def read_baseline(filename, section):
-    cfg = configparser.ConfigParser()
-    cfg.readfp(open(filename))
-    last_updated = datetime.datetime.strptime(
-        cfg.get(section, "last_updated"), "%Y-%m-%dT%H:%M:%S.%fZ")
-    logging.info(last_updated)
-    eco2 = cfg.getint(section, "eco2")
-    tvoc = cfg.getint(section, "tvoc")
+    # the file is the fixed format written by write_baseline
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    in_section = False
+    vals = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            in_section = line[1:-1] == section
+        elif in_section and '=' in line:
+            key, _, val = line.partition('=')
+            vals[key.strip()] = val.strip()
+    last_updated = parse_last_updated(vals["last_updated"])
+    eco2 = int(vals["eco2"])
+    tvoc = int(vals["tvoc"])
     return last_updated, eco2, tvoc
 
 
-def write_baseline(filename, section, last_updated, eco2, tvoc):
+def parse_last_updated(val):
+    # unix time in seconds, files written by older versions hold an
+    # ISO 8601 UTC time instead
     try:
-        cfg = configparser.ConfigParser()
-        try:
-            cfg.readfp(open(filename))
-        except Exception as err:
-            logging.warning("Failed to read sgp30 config: {}".format(err))
-
-        if not cfg.has_section(section):
-            cfg.add_section(section)
+        return float(val)
+    except ValueError:
+        pass
+    val = val.rstrip('Z')
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if '.' in val else "%Y-%m-%dT%H:%M:%S"
+    return datetime.datetime.strptime(val, fmt).replace(
+        tzinfo=datetime.timezone.utc).timestamp()
 
-        cfg.set(section, "last_updated", last_updated.isoformat() + "Z")
-        cfg.set(section, "eco2", eco2)
-        cfg.set(section, "tvoc", tvoc)
 
-        with open(filename, 'w') as f:
-            cfg.write(f)
+def write_baseline(filename, section, last_updated, eco2, tvoc):
+    # each sensor has its own file, write it whole and atomically replace
+    # the previous one so a restart mid-write can not corrupt it
+    try:
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            f.write("[%s]\nlast_updated = %.3f\neco2 = %d\ntvoc = %d\n" % (
+                section, last_updated, eco2, tvoc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
     except Exception as err:
         logging.error("Failed to write: {}".format(err))
 
 
-def csv_logger(name, basename, reactor, data_queue):
+def baseline_writer(filename, section, data_queue):
+    while True:
+        last_updated, eco2, tvoc = data_queue.get()
+        write_baseline(filename, section, last_updated, eco2, tvoc)
+        data_queue.task_done()
+
+
+CSV_COLUMNS = ['unix_time', 'monotonic_time', 'ECO2', 'TVOC', 'H2Raw',
+               'EthanolRaw']
+
+
+def csv_value(value):
+    # a status value as csv.writer would write it: numbers at full
+    # precision, None as an empty cell and anything else quoted if needed
+    if value.__class__ is float or value.__class__ is int:
+        return repr(value).encode()
+    if value is None:
+        return b""
+    value = str(value)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        value = '"' + value.replace('"', '""') + '"'
+    return value.encode()
+
+
+def csv_header(columns, temperature_keys, humidity_keys):
+    columns = list(columns)
+    columns.extend("temperature_{}".format(x) for x in temperature_keys)
+    columns.extend("humidity_{}".format(x) for x in humidity_keys)
+    return (",".join(columns) + "\n").encode()
+
+
+CSV_QUEUE_SIZE = 10000  # rows are dropped rather than growing without bound
+CSV_DROP_WARN = 1000  # warn on the first and every this many dropped rows
+CSV_FLUSH_ROWS = 16  # flush once this many rows are buffered
+CSV_FLUSH_TIME = 30.0  # or this many seconds after the last flush
+
+
+def csv_logger(name, basename, reactor, data_queue, data_event):
     try:
         def gcmd_result(gcmd, val):
             reactor.register_async_callback((lambda e: gcmd.respond_info(val)))
 
         csvfile = None
-        csvwriter = None
+        header = None
+        header_written = False
+        pending = 0
+        last_flush = time.monotonic()
         while True:
-            item = data_queue.get()
-            item_type = item['type']
-            if item_type == "start":
-                if not csvfile:
-                    filename = basename + datetime.datetime.now().strftime(
-                        "_%Y-%m-%d_%H-%M-%S.csv")
-                    csvfile = open(filename, 'w')
-                    gcmd_result(item['gcmd'],
-                                "sgp30 {}: csv logging started '{}'"
-                                .format(name, filename))
-                else:
-                    gcmd_result(item['gcmd'],
-                                "sgp30 {}: csv logging already started"
-                                .format(name))
-            elif item_type == "stop":
-                if csvfile:
-                    csvfile.close()
-                    csvfile = None
-                    csvwriter = None
-                    gcmd_result(item['gcmd'],
-                                "sgp30 {}: csv logging stopped".format(name))
-                else:
-                    gcmd_result(item['gcmd'],
-                                "sgp30 {}: csv logging already stopped"
-                                .format(name))
-            elif item_type == "update" and csvfile:
-                t = item['temperature']
-                h = item['humidity']
-
-                if not csvwriter:
-                    csvwriter = csv.writer(csvfile)
-                    row = ['unix_time', 'monotonic_time', 'ECO2',
-                           'TVOC', 'H2Raw', 'EthanolRaw']
-                    row.extend("temperature_{}".format(x) for x in sorted(t))
-                    row.extend("humidity_{}".format(x) for x in sorted(h))
-                    csvwriter.writerow(row)
-
-                row = [time.time(), item['monotonic'], item['eco2'],
-                       item['tvoc'], item['h2raw'], item['ethanolraw']]
-                row.extend(t[k] for k in sorted(t))
-                row.extend(h[k] for k in sorted(h))
-                csvwriter.writerow(row)
+            # wake up once the sampler queues something, while rows are
+            # buffered also wake up to write them out
+            if not data_event.wait(CSV_FLUSH_TIME if pending else None):
                 csvfile.flush()
-
-            data_queue.task_done()
+                pending = 0
+                last_flush = time.monotonic()
+                continue
+            data_event.clear()
+            while data_queue:
+                item = data_queue.popleft()
+                # rows arrive preformatted from the sampler
+                item_type = "update" if isinstance(item, bytes) \
+                    else item['type']
+                if item_type == "header":
+                    header = item['header']
+                    header_written = False
+                elif item_type == "start":
+                    if not csvfile:
+                        filename = basename + time.strftime(
+                            "_%Y-%m-%d_%H-%M-%S.csv")
+                        csvfile = open(filename, 'wb')
+                        header_written = False
+                        last_flush = time.monotonic()
+                        gcmd_result(item['gcmd'],
+                                    "sgp30 {}: csv logging started '{}'"
+                                    .format(name, filename))
+                    else:
+                        gcmd_result(item['gcmd'],
+                                    "sgp30 {}: csv logging already started"
+                                    .format(name))
+                elif item_type == "stop":
+                    if csvfile:
+                        csvfile.close()
+                        csvfile = None
+                        pending = 0
+                        gcmd_result(item['gcmd'],
+                                    "sgp30 {}: csv logging stopped"
+                                    .format(name))
+                    else:
+                        gcmd_result(item['gcmd'],
+                                    "sgp30 {}: csv logging already stopped"
+                                    .format(name))
+                elif item_type == "update" and csvfile:
+                    if not header_written and header:
+                        csvfile.write(header)
+                        header_written = True
+                    csvfile.write(item)
+
+                    pending += 1
+                    now = time.monotonic()
+                    if pending >= CSV_FLUSH_ROWS \
+                            or now - last_flush > CSV_FLUSH_TIME:
+                        csvfile.flush()
+                        pending = 0
+                        last_flush = now
     except Exception as err:
         logging.exception("sgp30 {}: csv error - {}".format(name, err))
 
@@ -354,6 +484,25 @@ _SGP30_FEATURESETS = (0x0020, 0x0022)
 _SGP30_CRC8_POLYNOMIAL = 0x31
 _SGP30_CRC8_INIT = 0xFF
 _SGP30_WORD_LEN = 2
+# Magnus formula constants folded together: 6.112 hPa * 216.7 / 100 %
+_SGP30_ABS_HUMIDITY_SCALE = 6.112 * 216.7 / 100.0
+
+
+def _build_crc8_table(polynomial):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = (crc << 1) ^ polynomial
+            else:
+                crc <<= 1
+        table.append(crc & 0xFF)
+    return bytes(table)
+
+
+# CRC-8 of every (crc ^ byte) value, one lookup per byte
+_SGP30_CRC8_TABLE = _build_crc8_table(_SGP30_CRC8_POLYNOMIAL)
 
 
 class Adafruit_SGP30:
@@ -361,6 +510,8 @@ class Adafruit_SGP30:
         """Initialize the sensor, get serial, and verify a proper SGP30"""
         self._i2c = i2c
         self._reactor = reactor
+        # last humidity sent, in the sensor's 8.8 fixed point format
+        self._last_humidity_ticks = None
 
         # get unique serial, its 48 bits so we store in an array
         self.serial = self._i2c_read_words_from_cmd([0x36, 0x82], 0.01, 3)
@@ -368,7 +519,20 @@ class Adafruit_SGP30:
         featureset = self._i2c_read_words_from_cmd([0x20, 0x2F], 0.01, 1)
         if featureset[0] not in _SGP30_FEATURESETS:
             raise RuntimeError("SGP30 Not detected")
-        self.iaq_init()
+
+        # iaq_init resets the sensor's algorithm state. A sensor that was
+        # not power cycled (klippy restart) still reports the baseline it
+        # has been tracking - keep it instead of starting over
+        self.warm_start = False
+        try:
+            baseline = self.get_iaq_baseline()
+        except RuntimeError:
+            baseline = [0, 0]
+        if baseline[0] and baseline[1]:
+            self.warm_start = True
+            self.set_iaq_baseline(baseline[0], baseline[1])
+        else:
+            self.iaq_init()
 
     @property
     # pylint: disable=invalid-name
@@ -413,18 +577,15 @@ class Adafruit_SGP30:
 
     def iaq_measure(self):
         """Measure the eCO2 and TVOC"""
-        # name, command, signals, delay
-        return self._run_profile(["iaq_measure", [0x20, 0x08], 2, 0.05])
+        return self._i2c_read_two_words_from_cmd([0x20, 0x08], 0.05)
 
     def raw_measure(self):
         """Measure H2 and Ethanol (Raw Signals)"""
-        # name, command, signals, delay
-        return self._run_profile(["raw_measure", [0x20, 0x50], 2, 0.025])
+        return self._i2c_read_two_words_from_cmd([0x20, 0x50], 0.025)
 
     def get_iaq_baseline(self):
         """Retreive the IAQ algorithm baseline for eCO2 and TVOC"""
-        # name, command, signals, delay
-        return self._run_profile(["iaq_get_baseline", [0x20, 0x15], 2, 0.01])
+        return self._i2c_read_two_words_from_cmd([0x20, 0x15], 0.01)
 
     def set_iaq_baseline(self, eCO2, TVOC):  # pylint: disable=invalid-name
         """Set previously recorded IAQ algorithm baseline for eCO2 and TVOC"""
@@ -440,25 +601,24 @@ class Adafruit_SGP30:
     def set_iaq_humidity(self, gramsPM3):  # pylint: disable=invalid-name
         """Set the humidity in g/m3 for eCO2 and TVOC compensation algorithm"""
         tmp = int(gramsPM3 * 256)
-        buffer = []
-        for value in [tmp]:
-            arr = [value >> 8, value & 0xFF]
-            arr.append(self._generate_crc(arr))
-            buffer += arr
-        self._run_profile(["iaq_set_humidity", [0x20, 0x61] + buffer, 0, 0.01])
-
-    def set_iaq_relative_humidity(self, celsius, relative_humidity):
+        if tmp == self._last_humidity_ticks:
+            # the sensor already has this value
+            return
+        word = [tmp >> 8, tmp & 0xFF]
+        self._i2c.i2c_write([0x20, 0x61] + word + [self._generate_crc(word)])
+        self._reactor.pause(self._reactor.monotonic() + 0.01)
+        self._last_humidity_ticks = tmp
+
+    def set_iaq_relative_humidity(self, celsius, relative_humidity,
+                                  _exp=exp):
         """
         Set the humidity in g/m3 for eCo2 and TVOC compensation algorithm.
         The absolute humidity is calculated from the temperature (Celsius)
         and relative humidity (as a percentage).
         """
-        numerator = ((relative_humidity / 100) * 6.112) * exp(
-            (17.62 * celsius) / (243.12 + celsius)
-        )
-        denominator = 273.15 + celsius
-
-        humidity_grams_pm3 = 216.7 * (numerator / denominator)
+        humidity_grams_pm3 = _SGP30_ABS_HUMIDITY_SCALE * relative_humidity \
+            * _exp((17.62 * celsius) / (243.12 + celsius)) \
+            / (273.15 + celsius)
         self.set_iaq_humidity(humidity_grams_pm3)
 
     # Low level command functions
@@ -476,36 +636,43 @@ class Adafruit_SGP30:
     def _i2c_read_words_from_cmd(self, command, delay, reply_size):
         """Run an SGP command query, get a reply and CRC results if necessary"""
         self._i2c.i2c_write(command)
-        t0 = self._reactor.monotonic()
         self._reactor.pause(self._reactor.monotonic() + delay)
-        dt = self._reactor.monotonic() - t0
         if not reply_size:
             return None
         params = self._i2c.i2c_read([], reply_size * (_SGP30_WORD_LEN + 1))
-        crc_result = bytearray(params['response'])
+        # big endian word followed by its crc, repeated
+        fields = struct.unpack('>' + 'HB' * reply_size, params['response'])
 
+        table = _SGP30_CRC8_TABLE
         result = []
-        for i in range(reply_size):
-            word = [crc_result[3 * i], crc_result[3 * i + 1]]
-            crc = crc_result[3 * i + 2]
-            if self._generate_crc(word) != crc:
+        for word, crc in zip(fields[0::2], fields[1::2]):
+            if table[table[_SGP30_CRC8_INIT ^ (word >> 8)]
+                     ^ (word & 0xFF)] != crc:
                 raise RuntimeError("CRC Error")
-            result.append(word[0] << 8 | word[1])
+            result.append(word)
         return result
 
+    def _i2c_read_two_words_from_cmd(self, command, delay):
+        """_i2c_read_words_from_cmd specialized for the two word replies
+           read every sample"""
+        self._i2c.i2c_write(command)
+        self._reactor.pause(self._reactor.monotonic() + delay)
+        r = self._i2c.i2c_read([], 2 * (_SGP30_WORD_LEN + 1))['response']
+        table = _SGP30_CRC8_TABLE
+        if table[table[_SGP30_CRC8_INIT ^ r[0]] ^ r[1]] != r[2] \
+                or table[table[_SGP30_CRC8_INIT ^ r[3]] ^ r[4]] != r[5]:
+            raise RuntimeError("CRC Error")
+        return [r[0] << 8 | r[1], r[3] << 8 | r[4]]
+
     # pylint: disable=no-self-use
-    def _generate_crc(self, data):
+    def _generate_crc(self, data, _table=_SGP30_CRC8_TABLE):
         """8-bit CRC algorithm for checking data"""
+        if len(data) == _SGP30_WORD_LEN:
+            return _table[_table[_SGP30_CRC8_INIT ^ data[0]] ^ data[1]]
         crc = _SGP30_CRC8_INIT
-        # calculates 8-Bit checksum with given polynomial
         for byte in data:
-            crc ^= byte
-            for _ in range(8):
-                if crc & 0x80:
-                    crc = (crc << 1) ^ _SGP30_CRC8_POLYNOMIAL
-                else:
-                    crc <<= 1
-        return crc & 0xFF
+            crc = _table[crc ^ byte]
+        return crc
 
 
 def load_config_prefix(config):
@@ -5,11 +5,12 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
 import logging
-import csv
 import time
 import threading
 import queue
 import datetime
+import collections
+from operator import itemgetter
 
 import adafruit_sgp40
 
@@ -20,6 +21,7 @@ class SGP40:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.name = config.get_name().split()[1]
+        self._log_prefix = "sgp40 {}:".format(self.name)
         self.reactor = self.printer.get_reactor()
         self.i2c = bus.MCU_I2C_from_config(
             config, default_addr=0x59, default_speed=400000)
@@ -28,11 +30,22 @@ class SGP40:
         self.sample_timer = self.reactor.register_timer(self.sample_sgp40)
         self.syslog_time = config.getfloat(
             "syslog_time", default=self.reactor.NEVER)
-        self.syslog_last_updated = self.reactor.NOW
+        self._syslog_enabled = 0 < self.syslog_time < self.reactor.NEVER
         self.csv_basename = config.get("csv_basename", default=None)
+        self._csv_enabled = bool(self.csv_basename)
+        # syslog and csv output both happen on the logger thread
+        self._logger_enabled = self._syslog_enabled or self._csv_enabled
+        self.csv_sample_every = config.getint(
+            "csv_sample_every", default=1, minval=1)
+        self._csv_sample_count = 0
+        self._warmup_count = 0
         self.csv_log_queue = queue.Queue()
-        self.air_quality = None
-        self.raw_measurement = None
+        self.csv_dropped = 0
+        self.csv_keys = None
+        self._csv_row_format = None
+        self._csv_getters = None
+        # (air_quality, raw), replaced as a whole after every sample
+        self._snapshot = (None, None)
         self.sgp40 = None
         self.temperature_sensor = None
         self.temperature_sensor_name = config.get(
@@ -52,6 +65,8 @@ class SGP40:
         self.printer.add_object("sgp40 " + self.name, self)
         self.printer.register_event_handler(
             "klippy:connect", self.handle_connect)
+        self.printer.register_event_handler(
+            "klippy:disconnect", self.handle_disconnect)
 
         if not self.temperature_sensor_name and not self.temperature_initial:
             raise config.error(
@@ -77,7 +92,7 @@ class SGP40:
 
     def cmd_CSV_LOGGING_START(self, gcmd):
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
+            self.queue_csv_item({
                 "type": "start",
                 "gcmd": gcmd
             })
@@ -87,7 +102,7 @@ class SGP40:
 
     def cmd_CSV_LOGGING_STOP(self, gcmd):
         if self.csv_basename:
-            self.csv_log_queue.put_nowait({
+            self.queue_csv_item({
                 "type": "stop",
                 "gcmd": gcmd
             })
@@ -95,6 +110,19 @@ class SGP40:
             gcmd.respond_info("sgp40 {}: csv_basename not specified"
                               .format(self.name))
 
+    def queue_csv_item(self, item):
+        # never grow without bound on a stalled logger, drop samples
+        # instead. control items are always queued so gcode gets a reply,
+        # files their header and the logger its shutdown
+        if self.csv_log_queue.qsize() >= CSV_QUEUE_SIZE \
+                and isinstance(item, SGP40Sample):
+            self.csv_dropped += 1
+            if self.csv_dropped % CSV_DROP_WARN == 1:
+                logging.warning("%s csv logger is behind, dropped %d rows",
+                                self._log_prefix, self.csv_dropped)
+            return
+        self.csv_log_queue.put_nowait(item)
+
     def handle_connect(self):
         self.sgp40 = adafruit_sgp40.Adafruit_SGP40(self.i2c, self.reactor)
 
@@ -106,13 +134,20 @@ class SGP40:
             self.humidity_sensor = self.printer.lookup_object(
                 self.humidity_sensor_name)
 
-        if self.csv_basename:
+        if self._logger_enabled:
             threading.Thread(target=csv_logger, args=(
-                self.name, self.csv_basename,
-                self.reactor, self.csv_log_queue)).start()
+                self.name, self.csv_basename, self.reactor,
+                self.csv_log_queue,
+                self.syslog_time if self._syslog_enabled else None),
+                daemon=True).start()
 
         self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
 
+    def handle_disconnect(self):
+        if self._logger_enabled:
+            # let the logger write out what it has buffered and exit
+            self.queue_csv_item({"type": "shutdown"})
+
     def sample_sgp40(self, eventtime):
         measured_time = self.reactor.monotonic()
 
@@ -121,110 +156,256 @@ class SGP40:
             if self.temperature_sensor \
             else {self.temperature_key: self.temperature_initial}
         tempC = temperature_status[self.temperature_key]
-        humidity_status = self.humidity_sensor.get_status(eventtime) \
-            if self.humidity_sensor \
-            else {self.humidity_key: self.humidity_initial}
+        if self.humidity_sensor is None:
+            humidity_status = {self.humidity_key: self.humidity_initial}
+        elif self.humidity_sensor is self.temperature_sensor:
+            # humidity_sensor defaults to temperature_sensor, one read
+            # returns both values
+            humidity_status = temperature_status
+        else:
+            humidity_status = self.humidity_sensor.get_status(eventtime)
         humidity = humidity_status[self.humidity_key]
 
+        # the i2c transfers stay on the reactor: MCU_I2C and reactor.pause
+        # are not thread safe, and each transfer already yields to other
+        # timers while it waits for the mcu response
         try:
             if tempC and humidity:
-                self.air_quality, self.raw_measurement = \
+                air_quality, raw_measurement = \
                     self.sgp40.measure_index(tempC, humidity)
             else:
                 # default temp/humidity
-                self.air_quality, self.raw_measurement = \
-                    self.sgp40.measure_index()
+                air_quality, raw_measurement = self.sgp40.measure_index()
+            self._snapshot = (air_quality, raw_measurement)
 
         except Exception as err:
             logging.exception(
-                "sgp40 {}: Error reading data - {}".format(self.name, err))
-            self.air_quality = .0
+                "%s Error reading data - %s", self._log_prefix, err)
+            self._snapshot = (.0, self._snapshot[1])
             return self.reactor.NEVER
 
-        # log measurement to syslog
-        now = self.reactor.monotonic()
-        if self.syslog_time > 0:
-            if now - self.syslog_last_updated > self.syslog_time:
-                logging.info("sgp40 {}: measured - Air Quality: {}, Raw: {}"
-                             .format(self.name, self.air_quality,
-                                     self.raw_measurement))
-                self.syslog_last_updated = now
-
-        # log measurement to csv
-        if self.csv_basename:
-            self.csv_log_queue.put_nowait({
-                "type": "update",
-                "monotonic": now,
-                "air_quality": self.air_quality,
-                "raw": self.raw_measurement,
-                "temperature": temperature_status,
-                "humidity": humidity_status
-            })
+        # hand the measurement to the logger thread in a single record,
+        # it takes care of the rate limited syslog and the csv file
+        if self._logger_enabled:
+            row = None
+            if self._csv_enabled and not self._warming_up(air_quality) \
+                    and self._csv_sample_due():
+                try:
+                    row = self._csv_row(measured_time, air_quality,
+                                        raw_measurement, temperature_status,
+                                        humidity_status)
+                except Exception as err:
+                    logging.exception("%s Error formatting csv row - %s",
+                                      self._log_prefix, err)
+            self.queue_csv_item(SGP40Sample(
+                measured_time, air_quality, raw_measurement, row))
 
         # schedule next loop
         return measured_time + self.report_time
 
+    def _csv_row(self, measured_time, air_quality, raw_measurement,
+                 temperature_status, humidity_status):
+        # the row is formatted here so the logger thread only has to
+        # write it. status dicts keep the same keys from sample to sample,
+        # only sort them again if the key sets change
+        keys = self.csv_keys
+        if keys is None or temperature_status.keys() != keys[2] \
+                or humidity_status.keys() != keys[3]:
+            t_keys = tuple(sorted(temperature_status))
+            h_keys = tuple(sorted(humidity_status))
+            keys = self.csv_keys = (t_keys, h_keys,
+                                    frozenset(t_keys), frozenset(h_keys))
+            self._csv_row_format = b"%.6f,%.6f,%d,%d" \
+                + b",%s" * (len(keys[0]) + len(keys[1])) + b"\n"
+            self._csv_getters = (status_getter(keys[0]),
+                                 status_getter(keys[1]))
+            self.queue_csv_item({
+                "type": "header",
+                "header": csv_header(CSV_COLUMNS, keys[0], keys[1])
+            })
+        t_get, h_get = self._csv_getters
+        return self._csv_row_format % (
+            (time.time(), measured_time, air_quality, raw_measurement)
+            + tuple(map(csv_value, t_get(temperature_status)
+                        + h_get(humidity_status))))
+
+    def _warming_up(self, air_quality):
+        # the VOC index reads 0 until the algorithm's initial blackout is
+        # over, those samples are not worth a csv row
+        if self._warmup_count >= VOC_WARMUP_SAMPLES:
+            return False
+        if air_quality:
+            self._warmup_count = VOC_WARMUP_SAMPLES
+            logging.info("%s VOC index warmup complete", self._log_prefix)
+            return False
+        self._warmup_count += 1
+        return True
+
+    def _csv_sample_due(self):
+        self._csv_sample_count += 1
+        if self._csv_sample_count < self.csv_sample_every:
+            return False
+        self._csv_sample_count = 0
+        return True
+
     def get_status(self, eventtime):
+        air_quality, raw = self._snapshot
         return {
-            'air_quality': self.air_quality,
-            'raw': self.raw_measurement,
+            'air_quality': air_quality,
+            'raw': raw,
         }
 
 
-def csv_logger(name, basename, reactor, data_queue):
+# samples the VOC algorithm reports an index of 0 for after start up,
+# matches _VOCALGORITHM_INITIAL_BLACKOUT at one sample per second
+VOC_WARMUP_SAMPLES = 45
+
+# one record per measurement for the logger thread, row is the preformatted
+# csv row or None if this measurement is not written to csv
+SGP40Sample = collections.namedtuple('SGP40Sample', [
+    'monotonic', 'air_quality', 'raw', 'row'])
+
+CSV_COLUMNS = ['unix_time', 'monotonic_time', 'air_quality', 'raw']
+
+
+def status_getter(keys):
+    # returns a function that pulls the values of keys out of a status dict
+    # as a tuple, itemgetter returns a bare value for a single key
+    if len(keys) > 1:
+        return itemgetter(*keys)
+    return lambda status: tuple([status[k] for k in keys])
+
+
+def csv_value(value):
+    # a status value as csv.writer would write it: numbers at full
+    # precision, None as an empty cell and anything else quoted if needed
+    if value.__class__ is float or value.__class__ is int:
+        return repr(value).encode()
+    if value is None:
+        return b""
+    value = str(value)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        value = '"' + value.replace('"', '""') + '"'
+    return value.encode()
+
+
+def csv_header(columns, temperature_keys, humidity_keys):
+    columns = list(columns)
+    columns.extend("temperature_{}".format(x) for x in temperature_keys)
+    columns.extend("humidity_{}".format(x) for x in humidity_keys)
+    return (",".join(columns) + "\n").encode()
+
+
+CSV_QUEUE_SIZE = 512  # samples are dropped once this many items are queued
+CSV_DROP_WARN = 100  # warn on the first and every this many dropped rows
+CSV_BUFFER_SIZE = 8192  # bytes buffered by the file object between flushes
+CSV_BATCH_SIZE = 64  # most queued items handled per wake up
+CSV_FLUSH_ROWS = 16  # flush once this many rows are buffered
+CSV_FLUSH_TIME = 30.0  # or this many seconds after the last flush
+
+
+def csv_logger(name, basename, reactor, data_queue, syslog_time):
     try:
         def gcmd_result(gcmd, val):
             reactor.register_async_callback((lambda e: gcmd.respond_info(val)))
 
         csvfile = None
-        csvwriter = None
+        syslog_last_updated = 0.
+        header = None
+        pending = 0
+        last_flush = time.monotonic()
         while True:
-            item = data_queue.get()
-            item_type = item['type']
-            if item_type == "start":
-                if not csvfile:
-                    filename = basename + datetime.datetime.now().strftime(
-                        "_%Y-%m-%d_%H-%M-%S.csv")
-                    csvfile = open(filename, 'w')
-                    gcmd_result(item['gcmd'],
-                                "sgp40 {}: csv logging started '{}'"
-                                .format(name, filename))
-                else:
-                    gcmd_result(item['gcmd'],
-                                "sgp40 {}: csv logging already started"
-                                .format(name))
-            elif item_type == "stop":
-                if csvfile:
-                    csvfile.close()
-                    csvfile = None
-                    csvwriter = None
-                    gcmd_result(item['gcmd'],
-                                "sgp40 {}: csv logging stopped".format(name))
-                else:
-                    gcmd_result(item['gcmd'],
-                                "sgp40 {}: csv logging already stopped"
-                                .format(name))
-            elif item_type == "update" and csvfile:
-                t = item['temperature']
-                h = item['humidity']
-
-                if not csvwriter:
-                    csvwriter = csv.writer(csvfile)
-                    row = ['unix_time', 'monotonic_time', 'air_quality', 'raw']
-                    row.extend("temperature_{}".format(x) for x in sorted(t))
-                    row.extend("humidity_{}".format(x) for x in sorted(h))
-                    csvwriter.writerow(row)
-
-                row = [time.time(), item['monotonic'],
-                       item['air_quality'], item['raw']]
-                row.extend(t[k] for k in sorted(t))
-                row.extend(h[k] for k in sorted(h))
-                csvwriter.writerow(row)
+            try:
+                items = [data_queue.get(timeout=CSV_FLUSH_TIME)
+                         if pending else data_queue.get()]
+            except queue.Empty:
+                # no new rows, write out what is buffered
                 csvfile.flush()
+                pending = 0
+                last_flush = time.monotonic()
+                continue
+            # take everything else already queued in the same pass
+            while len(items) < CSV_BATCH_SIZE:
+                try:
+                    items.append(data_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = []
+            shutdown = False
+            for item in items:
+                item_type = "sample" if isinstance(item, SGP40Sample) \
+                    else item['type']
+                if item_type == "sample":
+                    if syslog_time and item.monotonic - syslog_last_updated \
+                            > syslog_time:
+                        logging.info(
+                            "sgp40 %s: measured - Air Quality: %s, Raw: %s",
+                            name, item.air_quality, item.raw)
+                        syslog_last_updated = item.monotonic
+                    # rows arrive preformatted from the sampler, the header
+                    # is taken care of by the start and header items
+                    if csvfile and item.row:
+                        rows.append(item.row)
+                elif item_type == "header":
+                    header = item['header']
+                    if csvfile:
+                        rows.append(header)
+                elif item_type == "start":
+                    if not csvfile:
+                        filename = basename + \
+                            datetime.datetime.now().strftime(
+                                "_%Y-%m-%d_%H-%M-%S.csv")
+                        csvfile = open(filename, 'wb',
+                                       buffering=CSV_BUFFER_SIZE)
+                        if header:
+                            rows.append(header)
+                        last_flush = time.monotonic()
+                        gcmd_result(item['gcmd'],
+                                    "sgp40 {}: csv logging started '{}'"
+                                    .format(name, filename))
+                    else:
+                        gcmd_result(item['gcmd'],
+                                    "sgp40 {}: csv logging already started"
+                                    .format(name))
+                elif item_type == "stop":
+                    if csvfile:
+                        # rows queued ahead of the stop belong to this file
+                        csvfile.write(b"".join(rows))
+                        rows = []
+                        csvfile.close()
+                        csvfile = None
+                        pending = 0
+                        gcmd_result(item['gcmd'],
+                                    "sgp40 {}: csv logging stopped"
+                                    .format(name))
+                    else:
+                        gcmd_result(item['gcmd'],
+                                    "sgp40 {}: csv logging already stopped"
+                                    .format(name))
+                elif item_type == "shutdown":
+                    shutdown = True
+                    break
+
+            if rows:
+                csvfile.write(b"".join(rows))
+                pending += len(rows)
+                now = time.monotonic()
+                if pending >= CSV_FLUSH_ROWS \
+                        or now - last_flush > CSV_FLUSH_TIME:
+                    csvfile.flush()
+                    pending = 0
+                    last_flush = now
 
-            data_queue.task_done()
+            for _ in items:
+                data_queue.task_done()
+
+            if shutdown:
+                if csvfile:
+                    csvfile.close()
+                return
     except Exception as err:
-        logging.exception("sgp40 {}: csv error - {}".format(name, err))
+        logging.exception("sgp40 %s: csv error - %s", name, err)
 
 
 def load_config_prefix(config):
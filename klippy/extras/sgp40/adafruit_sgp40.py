@@ -118,6 +118,7 @@ class Adafruit_SGP40:
         self._reactor = reactor
         self._command_buffer = bytearray(2)
         self._measure_command = _READ_CMD
+        self._measure_args = (25, 50)
         self._voc_algorithm = None
 
         self.initialize()
@@ -223,14 +224,18 @@ class Adafruit_SGP40:
 
         The raw gas value adjusted for the current temperature (c) and humidity (%)
         """
-        # recycle a single buffer
-        _compensated_read_cmd = [0x26, 0x0F]
-        humidity_ticks = self._relative_humidity_to_ticks(relative_humidity)
-        humidity_ticks.append(self._generate_crc(humidity_ticks))
-        temp_ticks = self._celsius_to_ticks(temperature)
-        temp_ticks.append(self._generate_crc(temp_ticks))
-        _cmd = _compensated_read_cmd + humidity_ticks + temp_ticks
-        self._measure_command = bytearray(_cmd)
+        # the compensated command only changes with the inputs, reuse the
+        # previous one while temperature and humidity are steady
+        if (temperature, relative_humidity) != self._measure_args:
+            _compensated_read_cmd = [0x26, 0x0F]
+            humidity_ticks = self._relative_humidity_to_ticks(
+                relative_humidity)
+            humidity_ticks.append(self._generate_crc(humidity_ticks))
+            temp_ticks = self._celsius_to_ticks(temperature)
+            temp_ticks.append(self._generate_crc(temp_ticks))
+            _cmd = _compensated_read_cmd + humidity_ticks + temp_ticks
+            self._measure_command = bytearray(_cmd)
+            self._measure_args = (temperature, relative_humidity)
         return self.raw
 
     def measure_index(self, temperature=25, relative_humidity=50):